@@ -0,0 +1,136 @@
+"""選擇權核心計算 (不依賴 Streamlit,可在 process pool 子行程中匯入)"""
+import calendar
+import re
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+TW_TZ = timezone(timedelta(hours=8))
+MANUAL_SETTLEMENT_FIX = {'202501W1': '2025/01/02'}
+
+# 核心日期函式
+def get_settlement_date(contract_code):
+    code = str(contract_code).strip().upper()
+    for key, fix_date in MANUAL_SETTLEMENT_FIX.items():
+        if key in code: return fix_date
+    try:
+        if len(code) < 6: return "9999/99/99"
+        year, month = int(code[:4]), int(code[4:6])
+        c = calendar.monthcalendar(year, month)
+        wednesdays = [week[calendar.WEDNESDAY] for week in c if week[calendar.WEDNESDAY] != 0]
+        fridays = [week[calendar.FRIDAY] for week in c if week[calendar.FRIDAY] != 0]
+        day = None
+        if 'W' in code:
+            match = re.search(r'W(\d)', code)
+            if match and len(wednesdays) >= int(match.group(1)): day = wednesdays[int(match.group(1)) - 1]
+        elif 'F' in code:
+            match = re.search(r'F(\d)', code)
+            if match and len(fridays) >= int(match.group(1)): day = fridays[int(match.group(1)) - 1]
+        else:
+            if len(wednesdays) >= 3: day = wednesdays[2]
+        return f"{year}/{month:02d}/{day:02d}" if day else "9999/99/99"
+    except: return "9999/99/99"
+
+# 數學計算函數
+def calculate_iv_vec(option_price, spot_price, strike, time_to_expiry, is_call, risk_free_rate=0.015):
+    """Black-Scholes 隱含波動率 (整條鏈一次向量化 Newton 迭代),無解時回傳 NaN"""
+    price = np.asarray(option_price, dtype=float)
+    spot = np.broadcast_to(np.asarray(spot_price, dtype=float), price.shape)
+    strike = np.broadcast_to(np.asarray(strike, dtype=float), price.shape)
+    t = np.broadcast_to(np.asarray(time_to_expiry, dtype=float), price.shape)
+    is_call = np.broadcast_to(np.asarray(is_call, dtype=bool), price.shape)
+    sigma = np.full(price.shape, 0.3)
+    active = (price > 0) & (spot > 0) & (strike > 0) & (t > 0)
+    converged = np.zeros(price.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for i in range(50):
+            if not active.any(): break
+            sqrt_t = np.sqrt(t)
+            d1 = (np.log(spot / strike) + (risk_free_rate + 0.5 * sigma ** 2) * t) / (sigma * sqrt_t)
+            d2 = d1 - sigma * sqrt_t
+            discount = strike * np.exp(-risk_free_rate * t)
+            model = np.where(is_call, spot * norm.cdf(d1) - discount * norm.cdf(d2), discount * norm.cdf(-d2) - spot * norm.cdf(-d1))
+            vega = spot * norm.pdf(d1) * sqrt_t
+            done = active & ((vega == 0) | (np.abs(model - price) < 1e-4))
+            converged |= done
+            active &= ~done
+            sigma = np.where(active, sigma - (model - price) / np.where(vega == 0, 1, vega), sigma)
+            active &= sigma > 0
+    return np.where(converged, sigma, np.nan)
+
+def time_to_expiry_years(settlement_date, as_of=None):
+    today = datetime.strptime(as_of, '%Y/%m/%d').replace(tzinfo=TW_TZ) if as_of else datetime.now(tz=TW_TZ)
+    expiry = datetime.strptime(settlement_date, '%Y/%m/%d').replace(tzinfo=TW_TZ)
+    return max((expiry - today).days / 365.0, 0.001)
+
+def calculate_option_greeks(df, spot_price, settlement_date, risk_free_rate=0.015, as_of=None):
+    """整條鏈的 IV / Delta / Gamma / GEX (向量化),無法計算的欄位為 NaN;as_of 為計算基準日 (預設今天)"""
+    out = df.copy()
+    for col in ['IV', 'Delta', 'Gamma', 'GEX']: out[col] = np.nan
+    if not spot_price or spot_price <= 0 or out.empty: return out
+    t = time_to_expiry_years(settlement_date, as_of)
+    is_call = out['Type'].astype(str).str.contains('Call|買').to_numpy()
+    strike = out['Strike'].to_numpy(dtype=float)
+    iv = calculate_iv_vec(out['Price'].to_numpy(dtype=float), spot_price, strike, t, is_call, risk_free_rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = (np.log(spot_price / strike) + (risk_free_rate + 0.5 * iv ** 2) * t) / (iv * np.sqrt(t))
+        gamma = norm.pdf(d1) / (spot_price * iv * np.sqrt(t))
+    out['IV'] = iv
+    out['Delta'] = np.where(is_call, norm.cdf(d1), norm.cdf(d1) - 1)
+    out['Gamma'] = gamma
+    out['GEX'] = -gamma * out['OI'].to_numpy(dtype=float) * (spot_price ** 2) * 0.01
+    return out
+
+def calculate_dealer_gex(df, spot_price, settlement_date, greeks=None, as_of=None):
+    try:
+        if greeks is None: greeks = calculate_option_greeks(df, spot_price, settlement_date, as_of=as_of)
+        gex_data = greeks[(greeks['OI'] > 0) & (greeks['Gamma'] > 0)]
+        if not gex_data.empty: return gex_data.groupby('Strike')['GEX'].sum().reset_index()
+    except: pass
+    return None
+
+def calculate_implied_forwards(df, contracts, as_of=None, risk_free_rate=0.015, n_strikes=5):
+    """put-call parity: C - P = e^(-rT) (F - K),每個到期取最接近平價的 n 個履約價,一次向量化解出隱含遠期價
+    回傳以合約代碼為 index 的 DataFrame: settlement_date, T, Forward, Pricing_Spot (= F·e^(-rT),供 IV/Greeks 使用)"""
+    if df is None or df.empty or not contracts: return None
+    t_of = {c['code']: time_to_expiry_years(c['date'], as_of) for c in contracts}
+    chain = df[df['Month'].isin(t_of) & (df['Price'] > 0)]
+    is_call = chain['Type'].astype(str).str.contains('Call|買')
+    pairs = pd.merge(
+        chain[is_call].groupby(['Month', 'Strike'])['Price'].mean().rename('Call'),
+        chain[~is_call].groupby(['Month', 'Strike'])['Price'].mean().rename('Put'),
+        left_index=True, right_index=True
+    ).reset_index()
+    if pairs.empty: return None
+    pairs['T'] = pairs['Month'].map(t_of)
+    pairs['Diff'] = pairs['Call'] - pairs['Put']
+    pairs['Implied'] = pairs['Strike'] + pairs['Diff'] * np.exp(risk_free_rate * pairs['T'])
+    pairs['Rank'] = pairs['Diff'].abs().groupby(pairs['Month']).rank(method='first')
+    forwards = pairs[pairs['Rank'] <= n_strikes].groupby('Month').agg(Forward=('Implied', 'median'), T=('T', 'first'))
+    forwards['Pricing_Spot'] = forwards['Forward'] * np.exp(-risk_free_rate * forwards['T'])
+    forwards['settlement_date'] = forwards.index.map({c['code']: c['date'] for c in contracts})
+    return forwards
+
+def resolve_pricing_spot(forwards, contract, manual_spot=0, fetched_spot=None):
+    """定價用現貨:該到期隱含遠期折現 F·e^(-rT),手動輸入只以 (手動 - 抓到的現貨) 的位移套用,保留各到期的股利基差
+    沒有隱含遠期時才直接使用手動輸入或抓到的現貨"""
+    manual = float(manual_spot) if manual_spot and manual_spot > 0 else None
+    if forwards is not None and contract in forwards.index:
+        parity_spot = float(forwards.loc[contract, 'Pricing_Spot'])
+        return parity_spot + (manual - fetched_spot) if manual and fetched_spot else parity_spot
+    return manual or fetched_spot
+
+def calculate_max_pain(df):
+    """買方總履約價值最小的結算價 (只在掛牌履約價中找)"""
+    is_call = df['Type'].astype(str).str.contains('Call|買')
+    call_oi = df[is_call].groupby('Strike')['OI'].sum()
+    put_oi = df[~is_call].groupby('Strike')['OI'].sum()
+    strikes = np.sort(df['Strike'].dropna().unique())
+    if len(strikes) == 0: return None
+    call_oi = call_oi.reindex(strikes, fill_value=0).to_numpy(dtype=float)
+    put_oi = put_oi.reindex(strikes, fill_value=0).to_numpy(dtype=float)
+    settle, strike = strikes[:, None], strikes[None, :]
+    payout = (np.maximum(settle - strike, 0) * call_oi + np.maximum(strike - settle, 0) * put_oi).sum(axis=1)
+    return float(strikes[np.argmin(payout)])
@@ -3,30 +3,69 @@ import pandas as pd
 import plotly.graph_objects as go
 import requests
 import time
-from datetime import datetime, timedelta, timezone
-from io import StringIO
-import calendar
+from datetime import datetime, timedelta
+from io import StringIO, BytesIO
 import re
 import google.generativeai as genai
 from openai import OpenAI
 import streamlit.components.v1 as components
 import numpy as np
 from scipy.stats import norm
+from scipy.optimize import least_squares, brentq
 import urllib3
+import os
+import pickle
+import json
+import hashlib
+import sqlite3
+import tempfile
+import functools
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows 無 fcntl,快照改用各行程獨立的目錄
+    fcntl = None
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from analytics import (
+    TW_TZ, get_settlement_date, time_to_expiry_years, calculate_option_greeks,
+    calculate_dealer_gex, calculate_implied_forwards, resolve_pricing_spot
+)
+from backtest import build_backtest_tasks, run_backtest
 
 # 忽略 SSL 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-st.set_page_config(layout="wide", page_title="台指期籌碼戰情室 (莊家控盤版)")
-TW_TZ = timezone(timedelta(hours=8))
+# spawn / forkserver 的子行程會以 __mp_main__ 重新執行本檔,只需要函式定義,略過頁面設定與 AI 連線
+IS_POOL_WORKER = __name__ == "__mp_main__"
+if not IS_POOL_WORKER:
+    st.set_page_config(layout="wide", page_title="台指期籌碼戰情室 (莊家控盤版)")
 
 # 金鑰設定
 try:
     GEMINI_KEY = st.secrets.get("GEMINI_API_KEY", "")
     OPENAI_KEY = st.secrets.get("OPENAI_API_KEY", "")
+    SHARED_CACHE_PATH = st.secrets.get("SHARED_CACHE_PATH", "")
 except FileNotFoundError:
     GEMINI_KEY = ""
     OPENAI_KEY = ""
+    SHARED_CACHE_PATH = ""
+
+def _private_cache_dir():
+    """快取內容以 pickle 讀回,目錄必須只有自己可寫 (0700);不符合時改用本行程專屬的暫存目錄"""
+    path = os.path.join(os.path.expanduser("~"), ".cache", "taifex_dashboard")
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.stat(path)
+        if hasattr(os, 'getuid') and (info.st_uid != os.getuid() or info.st_mode & 0o077):
+            raise PermissionError(path)
+        return path
+    except OSError:
+        return tempfile.mkdtemp(prefix="taifex_dashboard_")
+
+# 同一台主機上的 worker 共用同一個快取檔 (SQLite WAL 不支援 NFS 等網路檔案系統,請勿跨主機共用)
+CACHE_DIR = _private_cache_dir()
+SHARED_CACHE_PATH = SHARED_CACHE_PATH or os.environ.get("SHARED_CACHE_PATH") or os.path.join(CACHE_DIR, "shared_cache.sqlite3")
 
 def get_gemini_model(api_key):
     if not api_key: return None, "未設定"
@@ -49,9 +88,8 @@ def get_openai_client(api_key):
     if not api_key: return None
     return OpenAI(api_key=api_key)
 
-gemini_model, gemini_name = get_gemini_model(GEMINI_KEY)
-openai_client = get_openai_client(OPENAI_KEY)
-MANUAL_SETTLEMENT_FIX = {'202501W1': '2025/01/02'}
+gemini_model, gemini_name = get_gemini_model(GEMINI_KEY) if not IS_POOL_WORKER else (None, "")
+openai_client = get_openai_client(OPENAI_KEY) if not IS_POOL_WORKER else None
 
 # AdSense
 ADSENSE_PUB_ID = 'ca-pub-4585150092118682'
@@ -63,28 +101,197 @@ def show_ad_placeholder():
     st.markdown(f"""<script async src="https://pagead2.googlesyndication.com/pagead/js/adsbygoogle.js?client={ADSENSE_PUB_ID}" crossorigin="anonymous"></script>""", unsafe_allow_html=True)
     st.markdown(f"""<div style='background:#f8f9fa;padding:40px;border:2px dashed #dee2e6;text-align:center;'><p style='color:#6c757d'>廣告位置 (Publisher ID: {ADSENSE_PUB_ID})</p></div>""", unsafe_allow_html=True)
 
-# 核心日期函式
-def get_settlement_date(contract_code):
-    code = str(contract_code).strip().upper()
-    for key, fix_date in MANUAL_SETTLEMENT_FIX.items():
-        if key in code: return fix_date
+# 跨行程共享快取 (SQLite)
+def _shared_cache_conn():
+    conn = sqlite3.connect(SHARED_CACHE_PATH, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL, expires REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, expires REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS last_good (key TEXT PRIMARY KEY, value BLOB, saved_at REAL, expires REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS health (endpoint TEXT PRIMARY KEY, failures INTEGER, open_until REAL, last_error TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS chain_history (data_date TEXT PRIMARY KEY, df BLOB)")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS cm_iv_index (data_date TEXT PRIMARY KEY, contract TEXT, settlement_date TEXT, {', '.join(c + ' REAL' for c in IV_INDEX_COLUMNS)}, params TEXT)")
+    return conn
+
+def shared_cache_get(key):
+    """讀取共享快取,過期或不存在回傳 None"""
     try:
-        if len(code) < 6: return "9999/99/99"
-        year, month = int(code[:4]), int(code[4:6])
-        c = calendar.monthcalendar(year, month)
-        wednesdays = [week[calendar.WEDNESDAY] for week in c if week[calendar.WEDNESDAY] != 0]
-        fridays = [week[calendar.FRIDAY] for week in c if week[calendar.FRIDAY] != 0]
-        day = None
-        if 'W' in code:
-            match = re.search(r'W(\d)', code)
-            if match and len(wednesdays) >= int(match.group(1)): day = wednesdays[int(match.group(1)) - 1]
-        elif 'F' in code:
-            match = re.search(r'F(\d)', code)
-            if match and len(fridays) >= int(match.group(1)): day = fridays[int(match.group(1)) - 1]
-        else:
-            if len(wednesdays) >= 3: day = wednesdays[2]
-        return f"{year}/{month:02d}/{day:02d}" if day else "9999/99/99"
-    except: return "9999/99/99"
+        with closing(_shared_cache_conn()) as conn:
+            row = conn.execute("SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+    except (sqlite3.Error, pickle.UnpicklingError, EOFError): return None
+
+def shared_cache_set(key, value, ttl):
+    now = time.time()
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, created, expires) VALUES (?, ?, ?, ?)", (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now, now + ttl))
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+    except sqlite3.Error: pass
+
+def shared_cache_delete(key):
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+    except sqlite3.Error: pass
+
+def _save_last_good(key, value):
+    """斷線備援快照獨立存放,重新整理 (shared_cache_clear) 不會清掉"""
+    now = time.time()
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute("INSERT OR REPLACE INTO last_good (key, value, saved_at, expires) VALUES (?, ?, ?, ?)", (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now, now + LAST_GOOD_TTL))
+            conn.execute("DELETE FROM last_good WHERE expires <= ?", (now,))
+    except sqlite3.Error: pass
+
+def _load_last_good(key):
+    """回傳 (value, saved_at),沒有快照時回傳 None"""
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            row = conn.execute("SELECT value, saved_at FROM last_good WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return (pickle.loads(row[0]), row[1]) if row else None
+    except (sqlite3.Error, pickle.UnpicklingError, EOFError): return None
+
+def shared_cache_clear(min_age=60, keep_prefix="option_chain:"):
+    """清除建立超過 min_age 秒的項目,避免多人同時重新整理時重複打期交所
+    不含 last_good 備援快照,也保留依日期建檔的選擇權報表 (其他 session 仍以該 key 讀取,內容不會變)"""
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute("DELETE FROM cache WHERE created <= ? AND key NOT LIKE ?", (time.time() - min_age, keep_prefix + "%"))
+    except sqlite3.Error: pass
+
+def _shared_cache_lock(key, ttl):
+    now = time.time()
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute("DELETE FROM locks WHERE expires <= ?", (now,))
+            return conn.execute("INSERT OR IGNORE INTO locks (key, expires) VALUES (?, ?)", (key, now + ttl)).rowcount == 1
+    except sqlite3.Error: return True
+
+def _shared_cache_locked(key):
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            return conn.execute("SELECT 1 FROM locks WHERE key = ? AND expires > ?", (key, time.time())).fetchone() is not None
+    except sqlite3.Error: return False
+
+def _shared_cache_unlock(key):
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute("DELETE FROM locks WHERE key = ?", (key,))
+    except sqlite3.Error: pass
+
+def shared_cached(ttl, lock_timeout=45, endpoint=None):
+    """跨 worker 共用抓取結果;同一時間只有一個 worker 會實際打期交所,其他 worker 等待結果
+    指定 endpoint 時,抓取失敗會改用最後一次成功的快照並標記為過期資料"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = f"{func.__name__}:{args!r}:{sorted(kwargs.items())!r}"
+            value = shared_cache_get(key)
+            if value is not None: return value
+            locked = _shared_cache_lock(key, lock_timeout)
+            if not locked:
+                deadline = time.time() + lock_timeout
+                while time.time() < deadline and _shared_cache_locked(key):
+                    time.sleep(0.5)
+                value = shared_cache_get(key)
+                if value is not None: return value
+            try:
+                value = func(*args, **kwargs)
+                if value is not None:
+                    shared_cache_set(key, value, ttl)
+                    if endpoint:
+                        _save_last_good(key, value)
+                        shared_cache_delete(f"stale:{endpoint}")
+                elif endpoint:
+                    snapshot = _load_last_good(key)
+                    if snapshot:
+                        value, saved_at = snapshot
+                        shared_cache_set(key, value, STALE_RETRY_TTL)
+                        shared_cache_set(f"stale:{endpoint}", saved_at, ttl)
+                return value
+            finally:
+                if locked: _shared_cache_unlock(key)
+        return wrapper
+    return decorator
+
+OPTION_CHAIN_TTL = 86400
+IV_INDEX_MONEYNESS = [0.90, 0.95, 1.00, 1.05, 1.10]
+IV_INDEX_COLUMNS = ['atm_iv', 'rr25'] + [f"iv_m{round(m * 100)}" for m in IV_INDEX_MONEYNESS]
+IV_INDEX_TENOR_DAYS = 30
+LAST_GOOD_TTL = 7 * 86400
+STALE_RETRY_TTL = 60
+
+# 期交所端點健康度 (斷路器 + 每次抓取的總時間預算)
+TAIFEX_ENDPOINTS = {
+    'optDailyMarketReport': '選擇權行情',
+    'futContractsDate': '法人期貨',
+    'callsAndPutsDate': '法人選擇權',
+}
+TAIFEX_FAILURE_THRESHOLD = 3
+TAIFEX_BACKOFF_BASE = 30
+TAIFEX_BACKOFF_MAX = 600
+TAIFEX_FETCH_BUDGET = 30
+
+def circuit_allows(endpoint):
+    """斷路器關閉或冷卻時間已過 (half-open) 時允許請求"""
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            row = conn.execute("SELECT open_until FROM health WHERE endpoint = ?", (endpoint,)).fetchone()
+    except sqlite3.Error: return True
+    return row is None or row[0] <= time.time()
+
+def _record_endpoint_result(endpoint, ok, error=""):
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            if ok:
+                conn.execute("INSERT OR REPLACE INTO health (endpoint, failures, open_until, last_error) VALUES (?, 0, 0, '')", (endpoint,))
+                return
+            row = conn.execute("SELECT failures FROM health WHERE endpoint = ?", (endpoint,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            open_until = 0
+            if failures >= TAIFEX_FAILURE_THRESHOLD:
+                # 指數退避: 30s, 60s, 120s ... 最長 10 分鐘
+                open_until = time.time() + min(TAIFEX_BACKOFF_BASE * 2 ** (failures - TAIFEX_FAILURE_THRESHOLD), TAIFEX_BACKOFF_MAX)
+            conn.execute("INSERT OR REPLACE INTO health (endpoint, failures, open_until, last_error) VALUES (?, ?, ?, ?)", (endpoint, failures, open_until, error[:200]))
+    except sqlite3.Error: pass
+
+def get_endpoint_health():
+    """回傳 {endpoint: {'open': bool, 'failures': int, 'last_error': str, 'stale_since': float|None}}"""
+    health = {}
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            rows = {r[0]: r[1:] for r in conn.execute("SELECT endpoint, failures, open_until, last_error FROM health")}
+    except sqlite3.Error: rows = {}
+    for endpoint in TAIFEX_ENDPOINTS:
+        failures, open_until, last_error = rows.get(endpoint, (0, 0, ""))
+        health[endpoint] = {'open': open_until > time.time(), 'failures': failures, 'last_error': last_error, 'stale_since': shared_cache_get(f"stale:{endpoint}")}
+    return health
+
+def taifex_available(endpoint, deadline):
+    return time.time() < deadline and circuit_allows(endpoint)
+
+def taifex_post(endpoint, url, payload, headers, deadline):
+    """帶斷路器與時間預算的 POST;斷路、逾時或連線失敗時回傳 None"""
+    remaining = deadline - time.time()
+    if remaining <= 0 or not circuit_allows(endpoint): return None
+    try:
+        res = requests.post(url, data=payload, headers=headers, timeout=min(10, remaining), verify=False)
+        res.raise_for_status()
+    except requests.RequestException as e:
+        _record_endpoint_result(endpoint, False, str(e))
+        return None
+    _record_endpoint_result(endpoint, True)
+    res.encoding = 'utf-8'
+    return res
+
+def shared_memoize(key, compute, ttl=3600):
+    """計算結果 (OI 變化、GEX 等) 以 key 存入共享快取,所有 session 共用"""
+    value = shared_cache_get(key)
+    if value is None:
+        value = compute()
+        if value is not None: shared_cache_set(key, value, ttl)
+    return value
 
 @st.cache_data(ttl=60)
 def get_realtime_data():
@@ -113,43 +320,15 @@ def get_realtime_data():
     return taiex
 
 @st.cache_data(ttl=300)
-def get_futures_data():
-    """獲取台指期貨價格"""
-    url = "https://www.taifex.com.tw/cht/3/futContractsDate"
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    
-    for i in range(30):
-        target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
-        query_date = target_date.strftime('%Y/%m/%d')
-        payload = {'queryType': '1', 'marketCode': '0', 'commodity_id': 'TX', 'queryDate': query_date}
-        
-        try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
-            if "查無資料" in res.text: continue
-            
-            dfs = pd.read_html(StringIO(res.text))
-            if not dfs: continue
-            df = dfs[0]
-            
-            futures_price = None
-            for col in df.columns:
-                if '收盤價' in str(col) or '成交價' in str(col):
-                    try: 
-                        futures_price = float(str(df.iloc[0][col]).replace(',', ''))
-                        if futures_price > 0: return futures_price, None, query_date
-                    except: pass
-        except: pass
-    
-    return None, None, "N/A"
-
-@st.cache_data(ttl=300)
+@shared_cached(ttl=300, endpoint='futContractsDate')
 def get_institutional_futures_position():
     """獲取法人期貨淨部位 - 使用 queryType=2"""
     url = "https://www.taifex.com.tw/cht/3/futContractsDate"
     headers = {'User-Agent': 'Mozilla/5.0'}
     
+    deadline = time.time() + TAIFEX_FETCH_BUDGET
     for i in range(10):
+        if not taifex_available('futContractsDate', deadline): break
         target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
         query_date = target_date.strftime('%Y/%m/%d')
         
@@ -160,8 +339,8 @@ def get_institutional_futures_position():
         }
         
         try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
+            res = taifex_post('futContractsDate', url, payload, headers, deadline)
+            if res is None: continue
             
             if "查無資料" in res.text or len(res.text) < 5000:
                 continue
@@ -197,17 +376,22 @@ def get_institutional_futures_position():
                 return inst_data
                 
         except Exception as e:
+            # 報表格式變動等解析錯誤同樣記入端點健康狀態
+            _record_endpoint_result('futContractsDate', False, f"解析失敗: {e}")
             continue
     
     return None
 
 @st.cache_data(ttl=300)
+@shared_cached(ttl=300, endpoint='callsAndPutsDate')
 def get_institutional_option_data():
     """獲取法人選擇權數據 - 使用 queryType=2"""
     url = "https://www.taifex.com.tw/cht/3/callsAndPutsDate"
     headers = {'User-Agent': 'Mozilla/5.0'}
     
+    deadline = time.time() + TAIFEX_FETCH_BUDGET
     for i in range(10):
+        if not taifex_available('callsAndPutsDate', deadline): break
         target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
         query_date = target_date.strftime('%Y/%m/%d')
         
@@ -218,8 +402,8 @@ def get_institutional_option_data():
         }
         
         try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
+            res = taifex_post('callsAndPutsDate', url, payload, headers, deadline)
+            if res is None: continue
             
             if "查無資料" in res.text or len(res.text) < 5000:
                 continue
@@ -259,26 +443,31 @@ def get_institutional_option_data():
                 return inst_data
                 
         except Exception as e:
+            # 報表格式變動等解析錯誤同樣記入端點健康狀態
+            _record_endpoint_result('callsAndPutsDate', False, f"解析失敗: {e}")
             continue
     
     return None
 
 # 🔥🔥🔥 核心修正:選擇權數據抓取 - 使用原本驗證過的邏輯
 @st.cache_data(ttl=300)
+@shared_cached(ttl=300, endpoint='optDailyMarketReport')
 def get_option_data_multi_days(days=3):
     """獲取選擇權全市場數據 (原始版本 - 已驗證可用)"""
     url = "https://www.taifex.com.tw/cht/3/optDailyMarketReport"
     headers = {'User-Agent': 'Mozilla/5.0'}
     all_data = []
 
+    deadline = time.time() + TAIFEX_FETCH_BUDGET
     for i in range(30):
+        if not taifex_available('optDailyMarketReport', deadline): break
         target_date = datetime.now(tz=TW_TZ) - timedelta(days=i)
         query_date = target_date.strftime('%Y/%m/%d')
         payload = {'queryType': '2', 'marketCode': '0', 'commodity_id': 'TXO', 'queryDate': query_date, 'MarketCode': '0', 'commodity_idt': 'TXO'}
         
         try:
-            res = requests.post(url, data=payload, headers=headers, timeout=10, verify=False)
-            res.encoding = 'utf-8'
+            res = taifex_post('optDailyMarketReport', url, payload, headers, deadline)
+            if res is None: continue
             if "查無資料" in res.text or len(res.text) < 500: continue
             
             dfs = pd.read_html(StringIO(res.text))
@@ -317,7 +506,9 @@ def get_option_data_multi_days(days=3):
             
             # 驗證是否找到所有必要欄位
             required = ['Month', 'Strike', 'Type', 'OI', 'Price']
-            if not all(k in col_map for k in required):
+            missing = [k for k in required if k not in col_map]
+            if missing:
+                _record_endpoint_result('optDailyMarketReport', False, f"報表缺少欄位: {', '.join(missing)}")
                 continue
             
             # 重新命名欄位
@@ -335,82 +526,202 @@ def get_option_data_multi_days(days=3):
                 all_data.append({'date': query_date, 'df': df_clean})
                 if len(all_data) >= days: break
         except Exception as e:
+            # 報表格式變動等解析錯誤同樣記入端點健康狀態
+            _record_endpoint_result('optDailyMarketReport', False, f"解析失敗: {e}")
             continue
             
     return all_data if len(all_data) >= 1 else None
 
-# 數學計算函數
-def calculate_iv(option_price, spot_price, strike, time_to_expiry, option_type='call', risk_free_rate=0.015):
-    if option_price <= 0 or spot_price <= 0 or strike <= 0 or time_to_expiry <= 0: return None
-    sigma = 0.3
-    for i in range(50):
-        d1 = (np.log(spot_price / strike) + (risk_free_rate + 0.5 * sigma ** 2) * time_to_expiry) / (sigma * np.sqrt(time_to_expiry))
-        d2 = d1 - sigma * np.sqrt(time_to_expiry)
-        if option_type == 'call': price = spot_price * norm.cdf(d1) - strike * np.exp(-risk_free_rate * time_to_expiry) * norm.cdf(d2)
-        else: price = strike * np.exp(-risk_free_rate * time_to_expiry) * norm.cdf(-d2) - spot_price * norm.cdf(-d1)
-        vega = spot_price * norm.pdf(d1) * np.sqrt(time_to_expiry)
-        if vega == 0 or abs(price - option_price) < 1e-4: return sigma
-        sigma -= (price - option_price) / vega
-        if sigma <= 0: return None
-    return None
+TXO_MULTIPLIER = 50
+
+def _bs_price_delta_gamma(spot, strike, t, sigma, is_call, risk_free_rate=0.015):
+    sqrt_t = np.sqrt(t)
+    d1 = (np.log(spot / strike) + (risk_free_rate + 0.5 * sigma ** 2) * t) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    discount = strike * np.exp(-risk_free_rate * t)
+    cdf_d1 = norm.cdf(d1)
+    price = np.where(is_call, spot * cdf_d1 - discount * norm.cdf(d2), discount * norm.cdf(-d2) - spot * (1 - cdf_d1))
+    delta = np.where(is_call, cdf_d1, cdf_d1 - 1)
+    gamma = norm.pdf(d1) / (spot * sigma * sqrt_t)
+    return price, delta, gamma
+
+def calculate_scenario_grid(greeks_df, spot_price, settlement_date, spot_moves=None, iv_shifts=None, days_forward=None, risk_free_rate=0.015, index_level=None):
+    """莊家 (選擇權賣方) 情境分析:現貨變動 × IV 平移 × 經過天數,整條鏈一次廣播重新定價
+    沿用 calculate_option_greeks 算好的 IV;回傳的 delta / gamma / pnl 形狀為 [天數, IV 平移, 現貨變動]
+    spot_price 為定價用現貨 (F·e^(-rT));spot_levels 以相同漲跌幅換算成加權指數點位,未提供 index_level 時沿用定價現貨"""
+    if greeks_df is None or not spot_price or spot_price <= 0: return None
+    chain = greeks_df[(greeks_df['OI'] > 0) & (greeks_df['IV'] > 0)]
+    if chain.empty: return None
+    # 奇數點數讓網格包含「不變」(0%) 的格子
+    spot_moves = np.linspace(-0.05, 0.05, 51) if spot_moves is None else np.asarray(spot_moves, dtype=float)
+    iv_shifts = np.linspace(-0.10, 0.10, 21) if iv_shifts is None else np.asarray(iv_shifts, dtype=float)
+    days_forward = np.arange(5) if days_forward is None else np.asarray(days_forward, dtype=float)
+    t_now = time_to_expiry_years(settlement_date)
+    # 到期日 (含) 之後的天數無法定價,直接捨去 (T+0 一定保留)
+    days_forward = days_forward[days_forward / 365.0 < t_now]
+
+    # 軸順序: [天數, IV 平移, 現貨變動, 履約價]
+    strike = chain['Strike'].to_numpy(dtype=float)
+    iv_now = chain['IV'].to_numpy(dtype=float)
+    oi = chain['OI'].to_numpy(dtype=float)
+    is_call = chain['Type'].astype(str).str.contains('Call|買').to_numpy()
+    spot = spot_price * (1 + spot_moves)[None, None, :, None]
+    sigma = np.maximum(iv_now + iv_shifts[:, None, None], 0.01)[None, :, :, :]
+    t = np.maximum(t_now - days_forward / 365.0, 1e-4)[:, None, None, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base_price, _, _ = _bs_price_delta_gamma(spot_price, strike, t_now, iv_now, is_call, risk_free_rate)
+        price, delta, gamma = _bs_price_delta_gamma(spot, strike, t, sigma, is_call, risk_free_rate)
+    dealer_oi = -oi
+    return {
+        'spot_levels': (index_level or spot_price) * (1 + spot_moves),
+        'spot_label': "加權指數" if index_level else "定價現貨 (F·e^(-rT))",
+        'iv_shifts': iv_shifts,
+        'days_forward': days_forward,
+        'delta': np.nansum(dealer_oi * delta, axis=-1),
+        'gamma': np.nansum(dealer_oi * gamma, axis=-1) * (spot[..., 0] ** 2) * 0.01,
+        'pnl': np.nansum(dealer_oi * (price - base_price), axis=-1) * TXO_MULTIPLIER,
+    }
 
-def calculate_greeks(spot_price, strike, time_to_expiry, volatility, option_type='call', risk_free_rate=0.015):
-    if volatility is None or volatility <= 0 or time_to_expiry <= 0: return None, None
+def _svi_total_variance(params, k):
+    return params['a'] + params['b'] * (params['rho'] * (k - params['m']) + np.sqrt((k - params['m']) ** 2 + params['sigma'] ** 2))
+
+def smile_iv(smile, strike):
+    """由微笑參數直接算出任意履約價的 IV (O(1))"""
+    k = np.log(np.asarray(strike, dtype=float) / smile['forward'])
+    return np.sqrt(np.maximum(_svi_total_variance(smile, k), 1e-8) / smile['t'])
+
+def _smile_delta_strike(smile, call_delta):
+    """找出 N(d1) = call_delta 的 log-moneyness (call 25Δ 用 0.25, put 25Δ 用 0.75)"""
+    def objective(k):
+        w = max(_svi_total_variance(smile, k), 1e-8)
+        return norm.cdf((-k + 0.5 * w) / np.sqrt(w)) - call_delta
+    lo, hi = (0.0, 1.0) if call_delta < 0.5 else (-1.0, 0.0)
+    if objective(lo) * objective(hi) > 0: return None
+    return brentq(objective, lo, hi)
+
+def fit_volatility_smile(greeks_df, spot_price, settlement_date, risk_free_rate=0.015, as_of=None):
+    """以 OTM 選擇權的 IV 擬合單一到期的 SVI 微笑曲線,每個快照只算一次
+    回傳參數 dict (含 ATM IV、25Δ RR、25Δ 蝶式),資料不足或擬合失敗回傳 None;as_of 須與 greeks_df 的計算基準日一致"""
+    if greeks_df is None or not spot_price or spot_price <= 0: return None
     try:
-        d1 = (np.log(spot_price / strike) + (risk_free_rate + 0.5 * volatility ** 2) * time_to_expiry) / (volatility * np.sqrt(time_to_expiry))
-        if option_type == 'call': delta = norm.cdf(d1)
-        else: delta = norm.cdf(d1) - 1
-        gamma = norm.pdf(d1) / (spot_price * volatility * np.sqrt(time_to_expiry))
-        return delta, gamma
-    except: return None, None
-
-def calculate_dealer_gex(df, spot_price, settlement_date):
+        t = time_to_expiry_years(settlement_date, as_of)
+        forward = spot_price * np.exp(risk_free_rate * t)
+        is_call = greeks_df['Type'].astype(str).str.contains('Call|買')
+        otm = greeks_df[(is_call & (greeks_df['Strike'] >= forward)) | (~is_call & (greeks_df['Strike'] < forward))]
+        otm = otm[otm['IV'] > 0]
+        if len(otm) < 5: return None
+        k = np.log(otm['Strike'].to_numpy(dtype=float) / forward)
+        w = otm['IV'].to_numpy(dtype=float) ** 2 * t
+
+        def residuals(x):
+            return _svi_total_variance(dict(zip(['a', 'b', 'rho', 'm', 'sigma'], x)), k) - w
+        fit = least_squares(
+            residuals, x0=[w.min(), 0.1, 0.0, 0.0, 0.1],
+            bounds=([-w.max(), 0.0, -0.999, -1.0, 1e-4], [w.max() * 2, 10.0, 0.999, 1.0, 2.0])
+        )
+        if not fit.success: return None
+        smile = dict(zip(['a', 'b', 'rho', 'm', 'sigma'], map(float, fit.x)))
+        smile.update(forward=float(forward), t=float(t), spot=float(spot_price), rmse=float(np.sqrt(np.mean(fit.fun ** 2))))
+        smile['atm_iv'] = float(smile_iv(smile, forward))
+        k_call, k_put = _smile_delta_strike(smile, 0.25), _smile_delta_strike(smile, 0.75)
+        smile['rr25'] = smile['bf25'] = None
+        if k_call is not None and k_put is not None:
+            iv_call, iv_put = float(smile_iv(smile, forward * np.exp(k_call))), float(smile_iv(smile, forward * np.exp(k_put)))
+            smile['rr25'] = iv_call - iv_put
+            smile['bf25'] = (iv_call + iv_put) / 2 - smile['atm_iv']
+        return smile
+    except (ValueError, KeyError, RuntimeError): return None
+
+# IV Rank / 百分位索引 (30 天固定天期,每個交易日一列,由微笑參數推得,不重算歷史 IV)
+def get_iv_index_contracts(contracts, data_date, tenor_days=IV_INDEX_TENOR_DAYS):
+    """固定天期內插用的月選 (排除週選):到期日跨越 data_date + tenor_days 的前後兩檔,不足時只取一檔"""
+    monthly = sorted((c for c in contracts if c['date'] > data_date and 'W' not in c['code'] and 'F' not in c['code']), key=lambda c: c['date'])
+    if not monthly: return []
+    target = (datetime.strptime(data_date, '%Y/%m/%d') + timedelta(days=tenor_days)).strftime('%Y/%m/%d')
+    far = next((i for i, c in enumerate(monthly) if c['date'] >= target), len(monthly) - 1)
+    return monthly[max(far - 1, 0):far + 1]
+
+def constant_maturity_iv(smiles, target_t):
+    """兩檔微笑的 SVI 總變異數對時間線性內插 (同 log-moneyness),目標天期超出範圍時沿用最近一檔"""
+    near, far = smiles[0], smiles[-1]
+    weight = float(np.clip((target_t - near['t']) / (far['t'] - near['t']), 0, 1)) if far['t'] > near['t'] else 0.0
+    t = (1 - weight) * near['t'] + weight * far['t']
+    def iv_at(k):
+        w = (1 - weight) * _svi_total_variance(near, k) + weight * _svi_total_variance(far, k)
+        return float(np.sqrt(max(w, 1e-8) / t))
+    point = {f"iv_m{round(m * 100)}": iv_at(np.log(m)) for m in IV_INDEX_MONEYNESS}
+    point['atm_iv'] = iv_at(0.0)
+    point['rr25'] = (1 - weight) * near['rr25'] + weight * far['rr25'] if near['rr25'] is not None and far['rr25'] is not None else None
+    return point
+
+def compute_iv_index_point(df, contracts, data_date, tenor_days=IV_INDEX_TENOR_DAYS):
+    """以 data_date 為基準日 (不是今天) 擬合月選微笑並內插出固定天期指標,任一檔資料不足回傳 None"""
+    legs = get_iv_index_contracts(contracts, data_date, tenor_days)
+    forwards = calculate_implied_forwards(df, legs, as_of=data_date)
+    smiles = []
+    for leg in legs:
+        spot = resolve_pricing_spot(forwards, leg['code'])
+        greeks = calculate_option_greeks(df[df['Month'] == leg['code']], spot, leg['date'], as_of=data_date) if spot else None
+        smile = fit_volatility_smile(greeks, spot, leg['date'], as_of=data_date)
+        if smile is None: return None
+        smiles.append(smile)
+    if not smiles: return None
+    point = constant_maturity_iv(smiles, tenor_days / 365.0)
+    point.update(contract=",".join(leg['code'] for leg in legs), settlement_date=legs[-1]['date'], params=smiles)
+    return point
+
+def update_iv_index(data_date, point):
+    """每個交易日只寫入一次;已存在的列不覆蓋,重整頁面不會改寫歷史"""
     try:
-        today = datetime.now(tz=TW_TZ)
-        expiry = datetime.strptime(settlement_date, '%Y/%m/%d').replace(tzinfo=TW_TZ)
-        time_to_expiry = max((expiry - today).days / 365.0, 0.001)
-        gex_data = []
-        for idx, row in df.iterrows():
-            strike = row['Strike']
-            oi = row['OI']
-            price = row['Price']
-            option_type = 'call' if 'Call' in str(row['Type']) or '買' in str(row['Type']) else 'put'
-            if price > 0 and oi > 0:
-                iv = calculate_iv(price, spot_price, strike, time_to_expiry, option_type)
-                if iv:
-                    delta, gamma = calculate_greeks(spot_price, strike, time_to_expiry, iv, option_type)
-                    if gamma:
-                        gex = -gamma * oi * (spot_price ** 2) * 0.01
-                        gex_data.append({'Strike': strike, 'Type': option_type, 'OI': oi, 'Gamma': gamma, 'GEX': gex})
-        if gex_data: return pd.DataFrame(gex_data).groupby('Strike')['GEX'].sum().reset_index()
-    except: pass
-    return None
+        with closing(_shared_cache_conn()) as conn:
+            conn.execute(
+                f"INSERT OR IGNORE INTO cm_iv_index (data_date, contract, settlement_date, {', '.join(IV_INDEX_COLUMNS)}, params) VALUES ({', '.join(['?'] * (len(IV_INDEX_COLUMNS) + 4))})",
+                (data_date, point['contract'], point['settlement_date'], *[point[c] for c in IV_INDEX_COLUMNS], json.dumps(point['params']))
+            )
+    except sqlite3.Error: pass
 
-def calculate_risk_reversal(df, spot_price, settlement_date):
+def get_iv_index_row(data_date):
+    """讀回已寫入的當日指標,不存在時回傳 None"""
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            row = conn.execute(f"SELECT contract, {', '.join(IV_INDEX_COLUMNS)} FROM cm_iv_index WHERE data_date = ?", (data_date,)).fetchone()
+    except sqlite3.Error: return None
+    return dict(zip(['contract'] + IV_INDEX_COLUMNS, row)) if row else None
+
+def get_iv_index_version():
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            return conn.execute("SELECT COUNT(*), MAX(data_date), TOTAL(atm_iv) FROM cm_iv_index").fetchone()
+    except sqlite3.Error: return (0, None, 0)
+
+@st.cache_data(ttl=3600)
+def load_iv_index(version):
+    """固定天期序列各欄排序成陣列;version 變動才重建"""
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            index_df = pd.read_sql_query(f"SELECT {', '.join(IV_INDEX_COLUMNS)} FROM cm_iv_index", conn)
+    except (sqlite3.Error, pd.errors.DatabaseError): return {}
+    return {col: np.sort(index_df[col].dropna().to_numpy(dtype=float)) for col in IV_INDEX_COLUMNS}
+
+def query_iv_rank(iv_index, metric, value):
+    """O(log n) 查詢: IV Rank = 在歷史高低區間的位置,百分位 = 歷史中低於此值的比例"""
+    history = iv_index.get(metric)
+    if history is None or len(history) < 2 or value is None or np.isnan(value): return None
+    low, high = history[0], history[-1]
+    return {
+        'rank': float(np.clip((value - low) / (high - low) * 100, 0, 100)) if high > low else 50.0,
+        'percentile': float(np.searchsorted(history, value, side='right') / len(history) * 100),
+        'days': len(history),
+    }
+
+def calculate_risk_reversal(df, spot_price, settlement_date, smile=None):
+    """ATM IV 與 25Δ Risk Reversal,由微笑曲線內插 (未提供 smile 時當場擬合)"""
     try:
-        today = datetime.now(tz=TW_TZ)
-        expiry = datetime.strptime(settlement_date, '%Y/%m/%d').replace(tzinfo=TW_TZ)
-        time_to_expiry = max((expiry - today).days / 365.0, 0.001)
         atm_strike = min(df['Strike'], key=lambda x: abs(x - spot_price))
-        iv_delta_data = []
-        for idx, row in df.iterrows():
-            strike = row['Strike']
-            price = row['Price']
-            option_type = 'call' if 'Call' in str(row['Type']) or '買' in str(row['Type']) else 'put'
-            if price > 0:
-                iv = calculate_iv(price, spot_price, strike, time_to_expiry, option_type)
-                if iv:
-                    delta, _ = calculate_greeks(spot_price, strike, time_to_expiry, iv, option_type)
-                    if delta: iv_delta_data.append({'Strike': strike, 'Type': option_type, 'IV': iv, 'Delta': abs(delta)})
-        if not iv_delta_data: return None, None, None
-        iv_df = pd.DataFrame(iv_delta_data)
-        call_25d = iv_df[(iv_df['Type'] == 'call') & (iv_df['Delta'] > 0.2) & (iv_df['Delta'] < 0.3)]
-        put_25d = iv_df[(iv_df['Type'] == 'put') & (iv_df['Delta'] > 0.2) & (iv_df['Delta'] < 0.3)]
-        atm_iv = iv_df[iv_df['Strike'] == atm_strike]['IV'].mean()
-        if not call_25d.empty and not put_25d.empty:
-            rr = call_25d.iloc[0]['IV'] - put_25d.iloc[0]['IV']
-            return atm_iv, rr, atm_strike
-        return atm_iv, None, atm_strike
+        if smile is None: smile = fit_volatility_smile(calculate_option_greeks(df, spot_price, settlement_date), spot_price, settlement_date)
+        if smile is None: return None, None, atm_strike
+        return smile['atm_iv'], smile['rr25'], atm_strike
     except: return None, None, None
 
 def calculate_multi_day_oi_change(all_data):
@@ -423,8 +734,161 @@ def calculate_multi_day_oi_change(all_data):
             df_latest[f'OI_Change_D{i}'] = df_merged['OI'] - df_merged[f'OI_D{i}']
     return df_latest
 
+# 訊號回測
+def store_chain_history(all_option_data):
+    """每個交易日的全市場報表只存一次,供回測重播"""
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO chain_history (data_date, df) VALUES (?, ?)",
+                [(d['date'], pickle.dumps(d['df'], protocol=pickle.HIGHEST_PROTOCOL)) for d in all_option_data]
+            )
+    except sqlite3.Error: pass
+
+def get_chain_history_version():
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            return conn.execute("SELECT COUNT(*), MAX(data_date) FROM chain_history").fetchone()
+    except sqlite3.Error: return (0, None)
+
+def load_chain_history():
+    try:
+        with closing(_shared_cache_conn()) as conn:
+            rows = conn.execute("SELECT data_date, df FROM chain_history ORDER BY data_date").fetchall()
+    except sqlite3.Error: return []
+    return [{'date': d, 'df': pickle.loads(blob)} for d, blob in rows]
+
+@st.cache_data(ttl=3600)
+def get_backtest_results(history_version):
+    """history_version 變動 (新增交易日) 時才重新回測"""
+    return run_backtest(build_backtest_tasks(load_chain_history()))
+
+# 匯出
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'Arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+}
+
+@st.cache_data(ttl=3600, max_entries=32)
+def build_export(_df, contract, data_date, spot_price, settlement_date, fmt):
+    """依 (合約, 數據日期, 現貨, 格式) 快取匯出檔,含 IV / Greeks / GEX / OI 變化,只在使用者要求時產生"""
+    export_df = calculate_option_greeks(_df, spot_price, settlement_date).reset_index(drop=True)
+    if fmt == 'CSV': return export_df.to_csv(index=False).encode('utf-8-sig')
+    buf = BytesIO()
+    if fmt == 'Parquet': export_df.to_parquet(buf, index=False)
+    else: export_df.to_feather(buf)
+    return buf.getvalue()
+
+# 盤中快照 ring buffer (memmap 固定寬度陣列,寫入只是覆蓋一列)
+# 同主機的 worker 以 flock 互斥共用;沒有 fcntl 的平台每個行程各用一個目錄
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, "snapshots" if fcntl else f"snapshots_{os.getpid()}")
+SNAPSHOT_CAPACITY = 64
+SNAPSHOT_MAX_STRIKES = 256
+_SNAPSHOT_DTYPE = np.dtype([
+    ('ts', 'f8'), ('spot', 'f8'),
+    ('call_oi', 'f4', (SNAPSHOT_MAX_STRIKES,)), ('put_oi', 'f4', (SNAPSHOT_MAX_STRIKES,)),
+    ('call_px', 'f4', (SNAPSHOT_MAX_STRIKES,)), ('put_px', 'f4', (SNAPSHOT_MAX_STRIKES,)),
+])
+_SNAPSHOT_META_DTYPE = np.dtype([('head', 'i8'), ('count', 'i8'), ('strikes', 'f8', (SNAPSHOT_MAX_STRIKES,))])
+
+def _open_memmap(path, dtype, length):
+    exists = os.path.exists(path) and os.path.getsize(path) == dtype.itemsize * length
+    return np.memmap(path, dtype=dtype, mode='r+' if exists else 'w+', shape=(length,)), not exists
+
+@contextmanager
+def _snapshot_lock(buf):
+    """行程內用 threading.Lock,跨行程再加 flock (head / count / 履約價欄位都在鎖內更新)"""
+    with buf['lock']:
+        if fcntl: fcntl.flock(buf['lock_file'], fcntl.LOCK_EX)
+        try: yield
+        finally:
+            if fcntl: fcntl.flock(buf['lock_file'], fcntl.LOCK_UN)
+
+@st.cache_resource
+def open_snapshot_ring(contract):
+    """每個合約一個 ring buffer,行程內所有 session 共用同一組 memmap"""
+    os.makedirs(SNAPSHOT_DIR, mode=0o700, exist_ok=True)
+    base = os.path.join(SNAPSHOT_DIR, re.sub(r'\W', '_', contract))
+    buf = {'lock': threading.Lock(), 'lock_file': open(base + '.lock', 'a+')}
+    with _snapshot_lock(buf):
+        meta, meta_created = _open_memmap(base + '.meta', _SNAPSHOT_META_DTYPE, 1)
+        ring, ring_created = _open_memmap(base + '.ring', _SNAPSHOT_DTYPE, SNAPSHOT_CAPACITY)
+        if meta_created or ring_created:
+            meta['head'], meta['count'] = 0, 0
+            meta['strikes'] = np.nan
+            meta.flush()
+    buf.update(meta=meta, ring=ring)
+    return buf
+
+def _snapshot_slots(grid, strikes):
+    """履約價對應到固定欄位;新履約價佔用空欄位,滿了則略過 (-1)"""
+    slot_of = {k: i for i, k in enumerate(grid) if not np.isnan(k)}
+    free = iter(np.flatnonzero(np.isnan(grid)))
+    slots = np.full(len(strikes), -1)
+    for j, k in enumerate(strikes):
+        if k not in slot_of:
+            i = next(free, None)
+            if i is None: continue
+            grid[i] = k
+            slot_of[k] = i
+        slots[j] = slot_of[k]
+    return slots
+
+def capture_chain_snapshot(contract, df, spot_price):
+    """與上一筆快照不同時才寫入,回傳代表目前報表的快照時間戳 (新寫入或沿用上一筆)"""
+    buf = open_snapshot_ring(contract)
+    meta, ring = buf['meta'], buf['ring']
+    is_call = df['Type'].astype(str).str.contains('Call|買').to_numpy()
+    with _snapshot_lock(buf):
+        row = np.zeros(1, dtype=_SNAPSHOT_DTYPE)
+        row['ts'], row['spot'] = time.time(), spot_price or np.nan
+        for mask, oi_col, px_col in [(is_call, 'call_oi', 'call_px'), (~is_call, 'put_oi', 'put_px')]:
+            side = df[mask]
+            slots = _snapshot_slots(meta['strikes'][0], side['Strike'].to_numpy(dtype=float))
+            ok = slots >= 0
+            row[oi_col][0, slots[ok]] = side['OI'].to_numpy(dtype=float)[ok]
+            row[px_col][0, slots[ok]] = side['Price'].to_numpy(dtype=float)[ok]
+        row = row[0]
+        head, count = int(meta['head'][0]), int(meta['count'][0])
+        if count > 0:
+            last = ring[(head - 1) % SNAPSHOT_CAPACITY]
+            same_chain = all(np.array_equal(last[c], row[c]) for c in ['call_oi', 'put_oi', 'call_px', 'put_px'])
+            if same_chain and (last['spot'] == row['spot'] or (np.isnan(last['spot']) and np.isnan(row['spot']))): return float(last['ts'])
+        ring[head] = row
+        meta['head'] = (head + 1) % SNAPSHOT_CAPACITY
+        meta['count'] = min(count + 1, SNAPSHOT_CAPACITY)
+        ring.flush()
+        meta.flush()
+    return float(row['ts'])
+
+def get_snapshot_changes(contract, since_ts, until_ts):
+    """until_ts 與 since_ts 兩筆快照的差異 (純陣列相減),各取時間戳不晚於指定值的最新一筆
+    ring 由所有 session 共用,時間戳由各 session 自己記錄;since_ts 已被覆蓋時改用最舊一筆,無可比較時回傳 None"""
+    if since_ts is None or until_ts is None or since_ts >= until_ts: return None
+    buf = open_snapshot_ring(contract)
+    meta, ring = buf['meta'], buf['ring']
+    with _snapshot_lock(buf):
+        head, count = int(meta['head'][0]), int(meta['count'][0])
+        rows = [(head - 1 - i) % SNAPSHOT_CAPACITY for i in range(count)]  # 新到舊
+        latest_idx = next((i for i in rows if ring[i]['ts'] <= until_ts), None)
+        prev_idx = next((i for i in rows if ring[i]['ts'] <= since_ts), rows[-1] if rows else None)
+        if latest_idx is None or prev_idx is None or latest_idx == prev_idx: return None
+        latest, prev = ring[latest_idx].copy(), ring[prev_idx].copy()
+        grid = meta['strikes'][0].copy()
+    used = ~np.isnan(grid)
+    changes = pd.DataFrame({
+        'Strike': grid[used],
+        'Call_OI_Chg': (latest['call_oi'] - prev['call_oi'])[used],
+        'Put_OI_Chg': (latest['put_oi'] - prev['put_oi'])[used],
+        'Call_Px_Chg': (latest['call_px'] - prev['call_px'])[used],
+        'Put_Px_Chg': (latest['put_px'] - prev['put_px'])[used],
+    }).sort_values('Strike')
+    changes.attrs.update(spot_change=latest['spot'] - prev['spot'], since=prev['ts'], snapshots=count)
+    return changes
+
 # 圖表繪製函數
-def plot_tornado_chart(df_target, title_text, spot_price):
+def plot_tornado_chart(df_target, title_text, spot_price, changes=None):
     is_call = df_target['Type'].str.contains('買|Call', case=False, na=False)
     df_call = df_target[is_call][['Strike', 'OI', 'Amount']].rename(columns={'OI': 'Call_OI', 'Amount': 'Call_Amt'})
     df_put = df_target[~is_call][['Strike', 'OI', 'Amount']].rename(columns={'OI': 'Put_OI', 'Amount': 'Put_Amt'})
@@ -453,9 +917,17 @@ def plot_tornado_chart(df_target, title_text, spot_price):
         data['Put_Text'] = data.apply(lambda r: f"{'+' if r['Put_Change']>0 else ''}{int(r['Put_Change'])}" if r['Put_OI']>0 else "", axis=1)
         data['Call_Text'] = data.apply(lambda r: f"{'+' if r['Call_Change']>0 else ''}{int(r['Call_Change'])}" if r['Call_OI']>0 else "", axis=1)
 
+    # 🔥 上次重新整理後有變動的履約價加上外框
+    put_line, call_line = dict(width=0), dict(width=0)
+    if changes is not None and not changes.empty:
+        put_changed = data['Strike'].map(changes.set_index('Strike')[['Put_OI_Chg', 'Put_Px_Chg']].abs().sum(axis=1)).fillna(0) > 0
+        call_changed = data['Strike'].map(changes.set_index('Strike')[['Call_OI_Chg', 'Call_Px_Chg']].abs().sum(axis=1)).fillna(0) > 0
+        put_line = dict(color=np.where(put_changed, '#ffd700', 'rgba(0,0,0,0)'), width=np.where(put_changed, 3, 0))
+        call_line = dict(color=np.where(call_changed, '#ffd700', 'rgba(0,0,0,0)'), width=np.where(call_changed, 3, 0))
+
     fig = go.Figure()
-    fig.add_trace(go.Bar(y=data['Strike'], x=-data['Put_OI'], orientation='h', name='Put (支撐)', marker_color='#2ca02c', opacity=0.85, text=data['Put_Text'], textposition='outside', hovertemplate='Put OI: %{x}<br>Amt: %{customdata:.2f}億', customdata=data['Put_Amt']/1e8))
-    fig.add_trace(go.Bar(y=data['Strike'], x=data['Call_OI'], orientation='h', name='Call (壓力)', marker_color='#d62728', opacity=0.85, text=data['Call_Text'], textposition='outside', hovertemplate='Call OI: %{x}<br>Amt: %{customdata:.2f}億', customdata=data['Call_Amt']/1e8))
+    fig.add_trace(go.Bar(y=data['Strike'], x=-data['Put_OI'], orientation='h', name='Put (支撐)', marker_color='#2ca02c', marker_line=put_line, opacity=0.85, text=data['Put_Text'], textposition='outside', hovertemplate='Put OI: %{x}<br>Amt: %{customdata:.2f}億', customdata=data['Put_Amt']/1e8))
+    fig.add_trace(go.Bar(y=data['Strike'], x=data['Call_OI'], orientation='h', name='Call (壓力)', marker_color='#d62728', marker_line=call_line, opacity=0.85, text=data['Call_Text'], textposition='outside', hovertemplate='Call OI: %{x}<br>Amt: %{customdata:.2f}億', customdata=data['Call_Amt']/1e8))
     
     if spot_price:
         fig.add_hline(y=spot_price, line_dash="dash", line_color="#ff7f0e", line_width=2)
@@ -523,10 +995,87 @@ def plot_gex_chart(gex_df, spot_price):
     )
     return fig
 
+SCENARIO_METRICS = {
+    'pnl': ('莊家損益 (元)', 'RdYlGn'),
+    'delta': ('莊家 Delta (口)', 'RdBu'),
+    'gamma': ('莊家 Gamma (GEX)', 'RdBu'),
+}
+
+def plot_scenario_heatmap(scenario, metric, day_idx):
+    if scenario is None: return None
+    label, colorscale = SCENARIO_METRICS[metric]
+    fig = go.Figure(go.Heatmap(
+        x=scenario['spot_levels'],
+        y=scenario['iv_shifts'] * 100,
+        z=scenario[metric][day_idx],
+        colorscale=colorscale,
+        zmid=0,
+        colorbar=dict(title=label),
+        hovertemplate=scenario['spot_label'] + ': %{x:,.0f}<br>IV 變動: %{y:+.1f}%<br>' + label + ': %{z:,.0f}<extra></extra>'
+    ))
+    fig.update_layout(
+        title=f"{label} 情境分析 (T+{int(scenario['days_forward'][day_idx])} 天)",
+        xaxis_title=scenario['spot_label'],
+        yaxis_title="IV 變動 (百分點)",
+        xaxis=dict(tickformat=",", separatethousands=True),
+        height=450
+    )
+    return fig
+
 # AI 相關函數
-def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basis, atm_iv, risk_reversal, gex_summary, data_date):
-    df_ai = df.nlargest(30, 'Amount') if 'Amount' in df.columns else df
-    cols = [c for c in ['Strike','Type','OI','Amount','OI_Change_D1'] if c in df_ai.columns]
+AI_TOKEN_BUDGET = 1500
+
+def estimate_tokens(text):
+    """粗估 LLM token 數: 中文字約 1 token/字,其餘約 4 字元/token"""
+    cjk = len(re.findall(r'[\u3000-\u9fff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _oi_walls(df, is_call, top_n=3):
+    walls = []
+    for side, mask in [('Call', is_call), ('Put', ~is_call)]:
+        top = df[mask].groupby('Strike')['OI'].sum().nlargest(top_n)
+        walls.append(f"{side}: " + ", ".join(f"{int(k)}({int(v):,})" for k, v in top.items()))
+    return " | ".join(walls)
+
+def _oi_change_clusters(df, is_call, top_n=4):
+    """相鄰履約價、同方向的 OI 變化合併成區塊,取變化最大的幾塊"""
+    if 'OI_Change_D1' not in df.columns: return []
+    strikes_all = np.sort(df['Strike'].dropna().unique())
+    step = np.diff(strikes_all).min() if len(strikes_all) > 1 else 50
+    clusters = []
+    for side, mask in [('Call', is_call), ('Put', ~is_call)]:
+        chg = df[mask].groupby('Strike')['OI_Change_D1'].sum().sort_index()
+        chg = chg[chg != 0]
+        if chg.empty: continue
+        strikes, values = chg.index.to_numpy(dtype=float), chg.to_numpy(dtype=float)
+        breaks = (np.diff(strikes) > step * 2) | (np.diff(np.sign(values)) != 0)
+        group_ids = np.concatenate([[0], np.cumsum(breaks)])
+        for gid in np.unique(group_ids):
+            sel = group_ids == gid
+            clusters.append((side, strikes[sel].min(), strikes[sel].max(), values[sel].sum()))
+    clusters.sort(key=lambda c: abs(c[3]), reverse=True)
+    return [f"{side} {int(lo)}{'' if lo == hi else f'-{int(hi)}'}: {int(total):+,}" for side, lo, hi, total in clusters[:top_n]]
+
+def _gex_buckets(gex_summary, bucket=200, top_n=8):
+    if gex_summary is None or gex_summary.empty: return []
+    buckets = gex_summary.groupby((gex_summary['Strike'] // bucket) * bucket)['GEX'].sum()
+    buckets = buckets[buckets.abs().isin(buckets.abs().nlargest(top_n))].sort_index()
+    return [f"{int(k)}~{int(k + bucket)}: {v:+.3g}" for k, v in buckets.items()]
+
+def _rank_rows_by_information(df, spot_price):
+    """依 OI、金額、OI 變化與離現貨距離給每列資訊分數,高分在前"""
+    score = pd.Series(0.0, index=df.index)
+    for col in ['OI', 'Amount', 'OI_Change_D1']:
+        if col in df.columns:
+            values = df[col].abs().fillna(0)
+            if values.max() > 0: score += values / values.max()
+    if spot_price: score *= 0.5 + np.exp(-(df['Strike'] - spot_price).abs() / 1000)
+    return df.loc[score.sort_values(ascending=False).index]
+
+def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basis, atm_iv, risk_reversal, gex_summary, data_date, iv_stats=None, token_budget=AI_TOKEN_BUDGET):
+    """把籌碼壓縮成特徵摘要,再依資訊價值挑選明細列直到 token 預算用完
+    回傳 (payload, 預估 token 數)"""
+    is_call = df['Type'].astype(str).str.contains('Call|買')
     
     inst_opt_str = ""
     if inst_opt_data and isinstance(inst_opt_data, dict):
@@ -539,29 +1088,42 @@ def prepare_ai_data(df, inst_opt_data, inst_fut, futures_price, spot_price, basi
     
     inst_fut_str = ""
     if inst_fut:
-        for k,v in inst_fut.items(): 
-            if k != 'date': inst_fut_str += f"{k}: {v:+,} 口\n"
-    
-    gex_str = ""
-    if gex_summary is not None:
-        top_gex = gex_summary.loc[gex_summary['GEX'].abs().idxmax()]
-        gex_str = f"最大GEX履約價: {top_gex['Strike']} (GEX: {top_gex['GEX']:.2f})"
-
-    return f"""
-    數據日期: {data_date}
-    現貨: {spot_price}, 期貨: {futures_price}, 基差: {basis}
-    ATM IV: {atm_iv}, Risk Reversal: {risk_reversal}
-    Dealer GEX 重點: {gex_str}
-    
-    【選擇權重倉區】:
-    {df_ai[cols].to_csv(index=False)}
-    
-    【法人選擇權籌碼】:
-    {inst_opt_str}
+        inst_fut_str = ", ".join(f"{k} {v:+,}" for k, v in inst_fut.items() if k != 'date')
     
-    【法人期貨淨單】:
-    {inst_fut_str}
-    """
+    iv_stats_str = "; ".join(
+        f"{label} Rank {stats['rank']:.0f}% / 百分位 {stats['percentile']:.0f}% ({stats['days']}日)"
+        for label, stats in [('ATM IV', (iv_stats or {}).get('atm_iv')), ('RR', (iv_stats or {}).get('rr25'))] if stats
+    )
+    if iv_stats_str: iv_stats_str = f"{iv_stats['label']}: {iv_stats_str}"
+    fmt_pct = lambda v: f"{v*100:.2f}%" if v is not None and not pd.isna(v) else "N/A"
+    # 依重要性排列;超出預算時從最後一段開始捨棄 (前兩段一定保留)
+    sections = [
+        f"數據日期: {data_date}\n現貨: {spot_price}, 隱含遠期: {futures_price}, 基差: {basis}\nATM IV: {fmt_pct(atm_iv)}, 25Δ Risk Reversal: {fmt_pct(risk_reversal)}\n",
+        f"【OI 大牆】 {_oi_walls(df, is_call)}\n",
+        f"【法人期貨淨單 (口)】 {inst_fut_str or '無'}\n",
+        "【法人選擇權淨未平倉】\n" + (inst_opt_str or "無\n"),
+        f"【Dealer GEX 分佈 (每 200 點)】 {'; '.join(_gex_buckets(gex_summary)) or '無'}\n",
+        f"【OI 變化集中區】 {'; '.join(_oi_change_clusters(df, is_call)) or '無'}\n",
+        f"【IV 歷史位置】 {iv_stats_str or '歷史資料不足'}\n",
+    ]
+    while len(sections) > 2 and estimate_tokens("".join(sections)) > token_budget:
+        sections.pop()
+    header = "".join(sections)
+    rows_title = "【重點履約價明細】 履約價,C/P,OI,金額(億),OI變化\n"
+    tokens = estimate_tokens(header + rows_title)
+    if tokens <= token_budget: header += rows_title
+    rows = []
+    has_change = 'OI_Change_D1' in df.columns
+    for idx, row in _rank_rows_by_information(df, spot_price).iterrows():
+        change = f"{int(row['OI_Change_D1']):+}" if has_change and pd.notna(row['OI_Change_D1']) else ''
+        line = f"{int(row['Strike'])},{'C' if is_call[idx] else 'P'},{int(row['OI'])},{row['Amount']/1e8:.2f},{change}\n"
+        # 逐列估算會略為高估 (每列各自進位),因此累計值不會低於整段實際估算
+        line_tokens = estimate_tokens(line)
+        if tokens + line_tokens > token_budget: break
+        rows.append(line)
+        tokens += line_tokens
+    payload = header + "".join(rows)
+    return payload, estimate_tokens(payload)
 
 def build_ai_prompt(data_str, taiex_price):
     return f"""
@@ -580,18 +1142,55 @@ def build_ai_prompt(data_str, taiex_price):
     {data_str}
     """
 
-def ask_gemini(prompt):
+AI_TIMEOUTS = {'gemini': 90, 'chatgpt': 90}
+
+def ask_gemini(prompt, timeout=AI_TIMEOUTS['gemini']):
     if not gemini_model: return "未設定 Gemini Key"
-    try: return gemini_model.generate_content(prompt).text
+    try: return gemini_model.generate_content(prompt, request_options={'timeout': timeout}).text
     except Exception as e: return str(e)
 
-def ask_chatgpt(prompt):
+def ask_chatgpt(prompt, timeout=AI_TIMEOUTS['chatgpt']):
     if not openai_client: return "未設定 OpenAI Key"
     try:
-        res = openai_client.chat.completions.create(model="gpt-4o-mini", messages=[{"role":"user","content":prompt}])
+        res = openai_client.chat.completions.create(model="gpt-4o-mini", messages=[{"role":"user","content":prompt}], timeout=timeout)
         return res.choices[0].message.content
     except Exception as e: return str(e)
 
+AI_PROVIDERS = {
+    'gemini': ('🔮 Gemini', ask_gemini),
+    'chatgpt': ('💬 ChatGPT', ask_chatgpt),
+}
+
+def ask_ai_concurrently(prompt, providers):
+    """同一份 prompt 同時送給多個 AI,依完成順序 yield (provider, result)
+    逾時者不再等待並回報;已在執行中的請求無法中斷,由各 SDK 的 timeout 結束"""
+    executor = ThreadPoolExecutor(max_workers=len(providers))
+    start = time.time()
+    pending = {executor.submit(AI_PROVIDERS[p][1], prompt, AI_TIMEOUTS[p]): p for p in providers}
+    try:
+        while pending:
+            now = time.time()
+            for future in [f for f, p in pending.items() if now - start >= AI_TIMEOUTS[p]]:
+                provider = pending.pop(future)
+                yield provider, f"⏱️ {AI_PROVIDERS[provider][0]} 超過 {AI_TIMEOUTS[provider]} 秒未回應,已放棄等待"
+            if not pending: break
+            next_deadline = min(start + AI_TIMEOUTS[p] for p in pending.values())
+            done, _ = wait(pending, timeout=max(next_deadline - time.time(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def load_option_data(data_key, data_date):
+    """依 session 保存的 key 從共享快取取回選擇權數據,被淘汰時重新抓取
+    重新抓到的最新交易日與 session 的 data_date 不同時回傳 None (不寫入舊日期的 key)"""
+    all_option_data = shared_cache_get(data_key)
+    if all_option_data is None:
+        all_option_data = get_option_data_multi_days(days=2)
+        if not all_option_data or all_option_data[0]['date'] != data_date: return None
+        shared_cache_set(data_key, all_option_data, OPTION_CHAIN_TTL)
+    return all_option_data
+
 def get_next_contracts(df, data_date):
     """從數據中提取未結算的合約"""
     unique_codes = sorted(df['Month'].unique())
@@ -602,6 +1201,16 @@ def get_next_contracts(df, data_date):
             targets.append({'code': code, 'date': s_date})
     return targets
 
+def show_stale_data_warning():
+    """期交所端點斷路或改用舊快照時提示使用者"""
+    for endpoint, health in get_endpoint_health().items():
+        name = TAIFEX_ENDPOINTS[endpoint]
+        if health['stale_since']:
+            saved_at = datetime.fromtimestamp(health['stale_since'], tz=TW_TZ).strftime('%m/%d %H:%M')
+            st.warning(f"⚠️ 期交所「{name}」暫時無法連線,顯示 {saved_at} 的快照資料 (非最新)")
+        elif health['open']:
+            st.warning(f"⚠️ 期交所「{name}」連線異常,暫停重試中 ({health['last_error'][:60]})")
+
 # 主程式
 def main():
     if 'analysis_unlocked' not in st.session_state: 
@@ -620,7 +1229,9 @@ def main():
     # 側邊欄設定
     if st.sidebar.button("🔄 重新整理"):
         st.cache_data.clear()
+        shared_cache_clear()
         st.session_state.show_analysis_results = False
+        st.session_state.ai_results = {}
         st.session_state.selected_contract = None
         st.session_state.all_contracts = None
         st.rerun()
@@ -645,6 +1256,7 @@ def main():
         
         with st.spinner("🔄 正在載入數據..."):
             all_option_data = get_option_data_multi_days(days=2)
+        show_stale_data_warning()
         
         if not all_option_data:
             st.error("❌ 無法取得選擇權數據")
@@ -659,6 +1271,8 @@ def main():
             st.error("❌ 數據格式錯誤")
             return
         
+        store_chain_history(all_option_data)
+        
         # 提取所有合約
         all_contracts = get_next_contracts(df_temp, data_date)
         
@@ -666,9 +1280,11 @@ def main():
             st.error("❌ 找不到未結算的合約")
             return
         
-        # 儲存到 session_state
+        # 數據放共享快取,session_state 只保存 key
+        data_key = f"option_chain:{data_date}"
+        shared_cache_set(data_key, all_option_data, OPTION_CHAIN_TTL)
         st.session_state.all_contracts = all_contracts
-        st.session_state.all_option_data = all_option_data
+        st.session_state.option_data_key = data_key
         st.session_state.data_date = data_date
         st.rerun()
     
@@ -717,42 +1333,63 @@ def main():
     if st.session_state.selected_contract:
         selected_code = st.session_state.selected_contract
         settlement_date = st.session_state.settlement_date
-        all_option_data = st.session_state.all_option_data
+        data_key = st.session_state.option_data_key
+        all_option_data = load_option_data(data_key, st.session_state.data_date)
+        if not all_option_data:
+            # 數據已換日或抓取失敗:回到步驟 1 重新載入合約列表
+            st.session_state.selected_contract = None
+            st.session_state.all_contracts = None
+            st.rerun()
         
         st.markdown("---")
         st.markdown(f"## 📊 分析報告: {selected_code}")
         
         # 抓取其他數據
         with st.spinner("🔄 正在更新數據..."):
-            taiex_now = get_realtime_data()
-            futures_price, futures_volume, fut_date = get_futures_data()
+            taiex_now = fetched_spot = get_realtime_data()
             inst_fut_position = get_institutional_futures_position()
             inst_opt_data = get_institutional_option_data()
+        show_stale_data_warning()
         
         # 處理手動輸入
         if manual_spot > 0:
             taiex_now = manual_spot
-            st.sidebar.success(f"✅ 使用手動輸入: {int(manual_spot)} 點")
+            st.sidebar.success(f"✅ 使用手動輸入: {int(manual_spot)} 點 (相對自動抓取值的位移套用至 Greeks / GEX / 情境分析)")
         elif taiex_now:
             st.sidebar.info(f"ℹ️ 自動抓取: {int(taiex_now)} 點")
         else:
             st.sidebar.warning("⚠️ 無法取得現貨價格,請手動輸入")
         
         # 過濾選定合約的數據
-        df_full = calculate_multi_day_oi_change(all_option_data)
+        df_full = shared_memoize(f"{data_key}:oi_change", lambda: calculate_multi_day_oi_change(all_option_data))
         df_selected = df_full[df_full['Month'] == selected_code].copy()
         
         if df_selected.empty:
             st.error(f"❌ 找不到 {selected_code} 的數據")
             return
         
+        # 各到期的隱含遠期價 (put-call parity),取代另外抓期貨價格
+        forwards = shared_memoize(f"{data_key}:forwards:{datetime.now(tz=TW_TZ).strftime('%Y%m%d')}", lambda: calculate_implied_forwards(df_full, all_contracts))
+        futures_price = float(forwards.loc[selected_code, 'Forward']) if forwards is not None and selected_code in forwards.index else None
+        # 手動輸入的現貨以位移量套用到 Greeks / GEX / 微笑 / 情境分析
+        pricing_spot = resolve_pricing_spot(forwards, selected_code, manual_spot, fetched_spot)
         basis = (futures_price - taiex_now) if (taiex_now and futures_price) else None
         
-        st.sidebar.download_button(
-            "📥 下載數據", 
-            df_selected.to_csv(index=False).encode('utf-8-sig'), 
-            f"{selected_code}_data.csv"
-        )
+        # 匯出檔延遲產生:按下按鈕才計算,結果依 (合約, 日期, 現貨, 格式) 快取
+        st.sidebar.markdown("---")
+        st.sidebar.markdown("### 📥 匯出數據")
+        export_fmt = st.sidebar.selectbox("匯出格式", list(EXPORT_FORMATS), help="Parquet / Arrow 保留欄位型別,適合大量多日資料")
+        export_id = (selected_code, data_date, pricing_spot, export_fmt)
+        if st.sidebar.button("📦 產生匯出檔"):
+            st.session_state.export_request = export_id
+        if st.session_state.get('export_request') == export_id:
+            ext, mime = EXPORT_FORMATS[export_fmt]
+            st.sidebar.download_button(
+                "📥 下載數據",
+                build_export(df_selected, selected_code, data_date, pricing_spot, settlement_date, export_fmt),
+                f"{selected_code}_{data_date.replace('/', '')}.{ext}",
+                mime=mime
+            )
         
         # === 儀表板 ===
         c1, c2, c3, c4, c5 = st.columns(5)
@@ -767,8 +1404,8 @@ def main():
             spot_label += "(無數據)"
         
         c2.metric(spot_label, f"{int(taiex_now) if taiex_now else 'N/A'}")
-        c3.metric(f"台指期 ({fut_date[5:]})", f"{int(futures_price) if futures_price else 'N/A'}")
-        c4.metric("基差", f"{basis:.0f}" if basis else "N/A", delta_color="normal" if basis and basis > 0 else "inverse")
+        c3.metric(f"隱含遠期 ({selected_code})", f"{int(futures_price) if futures_price else 'N/A'}", help="由 put-call parity 從選擇權報價推得")
+        c4.metric("基差 (遠期-現貨)", f"{basis:.0f}" if basis else "N/A", delta_color="normal" if basis and basis > 0 else "inverse")
         
         call_amt = df_selected[df_selected['Type'].str.contains('Call|買')]['Amount'].sum()
         put_amt = df_selected[df_selected['Type'].str.contains('Put|賣')]['Amount'].sum()
@@ -848,17 +1485,70 @@ def main():
         # === 龍捲風圖 ===
         st.markdown(f"### 📊 {selected_code} 未平倉分佈 (結算: {settlement_date})")
         
-        fig = plot_tornado_chart(df_selected, f"{selected_code} 合約", taiex_now)
+        # 快照記錄抓到的現貨,不受各使用者的手動輸入影響
+        # 與本 session 上一次看到的快照比較 (有新快照才往前推),不受其他 session 寫入影響
+        latest_ts = capture_chain_snapshot(selected_code, df_selected, fetched_spot)
+        seen = st.session_state.setdefault('snapshot_seen', {})
+        since_ts, last_ts = seen.get(selected_code, (None, None))
+        if latest_ts != last_ts:
+            since_ts, last_ts = last_ts, latest_ts
+            seen[selected_code] = (since_ts, last_ts)
+        snapshot_changes = get_snapshot_changes(selected_code, since_ts, last_ts)
+        if snapshot_changes is not None:
+            changed = snapshot_changes[['Call_OI_Chg', 'Put_OI_Chg', 'Call_Px_Chg', 'Put_Px_Chg']].abs().sum(axis=1) > 0
+            since = datetime.fromtimestamp(snapshot_changes.attrs['since'], tz=TW_TZ).strftime('%H:%M:%S')
+            spot_change = snapshot_changes.attrs['spot_change']
+            spot_text = f"現貨 {spot_change:+.0f} 點" if not np.isnan(spot_change) else "現貨 N/A"
+            st.caption(f"🟨 自 {since} 以來 {int(changed.sum())} 個履約價變動 (黃框) | {spot_text} | 已保存 {snapshot_changes.attrs['snapshots']} 筆快照")
+        
+        fig = plot_tornado_chart(df_selected, f"{selected_code} 合約", taiex_now, changes=snapshot_changes)
         st.plotly_chart(fig, use_container_width=True)
         
         # GEX 分析
-        gex_data = calculate_dealer_gex(df_selected, taiex_now, settlement_date)
+        analytics_key = f"{data_key}:{selected_code}:{pricing_spot}:{datetime.now(tz=TW_TZ).strftime('%Y%m%d')}"
+        greeks_df = shared_memoize(f"{analytics_key}:greeks", lambda: calculate_option_greeks(df_selected, pricing_spot, settlement_date))
+        gex_data = shared_memoize(f"{analytics_key}:gex", lambda: calculate_dealer_gex(df_selected, pricing_spot, settlement_date, greeks=greeks_df))
+        smile = shared_memoize(f"{analytics_key}:smile", lambda: fit_volatility_smile(greeks_df, pricing_spot, settlement_date))
+        # IV 索引:30 天固定天期 (月選內插),以 data_date 為基準日計算,每個交易日只算一次
+        iv_stats = {}
+        iv_point = get_iv_index_row(data_date)
+        if iv_point is None:
+            iv_point = compute_iv_index_point(df_full, all_contracts, data_date)
+            if iv_point: update_iv_index(data_date, iv_point)
+        if iv_point:
+            iv_index = load_iv_index(get_iv_index_version())
+            iv_stats = {'label': f"{IV_INDEX_TENOR_DAYS}天固定天期", 'atm_iv_now': iv_point['atm_iv']}
+            iv_stats.update({m: query_iv_rank(iv_index, m, iv_point[m]) for m in ['atm_iv', 'rr25']})
         if gex_data is not None:
             st.markdown("#### Dealer Gamma Exposure (GEX)")
             fig_gex = plot_gex_chart(gex_data, taiex_now)
             if fig_gex:
                 st.plotly_chart(fig_gex, use_container_width=True)
         
+        if smile:
+            st.markdown("#### 🌊 波動率微笑 (SVI)")
+            v1, v2, v3, v4, v5 = st.columns(5)
+            v1.metric("ATM IV", f"{smile['atm_iv']*100:.1f}%")
+            v2.metric("25Δ Risk Reversal", f"{smile['rr25']*100:+.2f}%" if smile['rr25'] is not None else "N/A")
+            v3.metric("25Δ 蝶式", f"{smile['bf25']*100:+.2f}%" if smile['bf25'] is not None else "N/A")
+            atm_stats = iv_stats.get('atm_iv')
+            cm_label = f"{IV_INDEX_TENOR_DAYS}天"
+            v4.metric(f"IV Rank ({cm_label})", f"{atm_stats['rank']:.0f}%" if atm_stats else "N/A", help=f"{cm_label}固定天期 ATM IV ({iv_stats['atm_iv_now']*100:.1f}%) 在歷史高低區間的位置" if iv_stats else f"{cm_label}固定天期 ATM IV 在歷史高低區間的位置")
+            v5.metric(f"IV 百分位 ({cm_label})", f"{atm_stats['percentile']:.0f}%" if atm_stats else "N/A", help=f"歷史 {atm_stats['days']} 個交易日中低於今日的比例" if atm_stats else "歷史資料不足")
+        
+        # 情境分析 (每次 rerun 重新計算,51×21×5 網格只需數十毫秒)
+        scenario = calculate_scenario_grid(greeks_df, pricing_spot, settlement_date, index_level=taiex_now)
+        if scenario is not None:
+            st.markdown("#### 🎯 莊家情境分析 (現貨 × IV × 天數)")
+            col_s1, col_s2 = st.columns(2)
+            scenario_metric = col_s1.radio("指標", list(SCENARIO_METRICS), format_func=lambda m: SCENARIO_METRICS[m][0], horizontal=True)
+            if len(scenario['days_forward']) > 1:
+                day_idx = col_s2.slider("經過天數", 0, len(scenario['days_forward']) - 1, 0, help="只列出到期前的天數")
+            else:
+                day_idx = 0
+                col_s2.caption("距到期不足一天,只顯示 T+0")
+            st.plotly_chart(plot_scenario_heatmap(scenario, scenario_metric, day_idx), use_container_width=True)
+        
         st.markdown("---")
         
         # === AI 分析區 ===
@@ -867,38 +1557,84 @@ def main():
         if not gemini_model and not openai_client:
             st.error("❌ 未設定 AI API Key,無法使用分析功能")
         else:
-            col_ai1, col_ai2 = st.columns(2)
+            col_ai1, col_ai2, col_ai3 = st.columns(3)
             
             with col_ai1:
                 if st.button("🔮 Gemini 分析", disabled=not gemini_model, use_container_width=True):
                     st.session_state.show_analysis_results = True
                     st.session_state.ai_provider = 'gemini'
+                    st.session_state.ai_results = {}
+                    st.session_state.ai_request = True
             
             with col_ai2:
                 if st.button("💬 ChatGPT 分析", disabled=not openai_client, use_container_width=True):
                     st.session_state.show_analysis_results = True
                     st.session_state.ai_provider = 'chatgpt'
+                    st.session_state.ai_results = {}
+                    st.session_state.ai_request = True
+            
+            with col_ai3:
+                if st.button("⚡ 雙 AI 同時分析", disabled=not (gemini_model and openai_client), use_container_width=True):
+                    st.session_state.show_analysis_results = True
+                    st.session_state.ai_provider = 'both'
+                    st.session_state.ai_results = {}
+                    st.session_state.ai_request = True
             
             if st.session_state.show_analysis_results:
-                atm_iv, risk_reversal, atm_strike = calculate_risk_reversal(df_selected, taiex_now, settlement_date)
-                gex_summary = calculate_dealer_gex(df_selected, taiex_now, settlement_date)
+                atm_iv, risk_reversal, atm_strike = calculate_risk_reversal(df_selected, pricing_spot, settlement_date, smile=smile)
+                gex_summary = gex_data
                 
-                ai_data = prepare_ai_data(
+                ai_data, ai_data_tokens = prepare_ai_data(
                     df_selected, inst_opt_data, inst_fut_position, 
                     futures_price, taiex_now, basis, 
-                    atm_iv, risk_reversal, gex_summary, data_date
+                    atm_iv, risk_reversal, gex_summary, data_date, iv_stats=iv_stats
                 )
                 
                 prompt = build_ai_prompt(ai_data, taiex_now)
+                st.caption(f"📏 Prompt 預估 {estimate_tokens(prompt):,} tokens (數據 {ai_data_tokens:,} / 預算 {AI_TOKEN_BUDGET:,})")
                 
-                with st.spinner(f"🤖 {st.session_state.ai_provider.upper()} 分析中..."):
-                    if st.session_state.ai_provider == 'gemini':
-                        result = ask_gemini(prompt)
-                    else:
-                        result = ask_chatgpt(prompt)
-                    
-                    st.markdown("#### 📊 AI 分析結果")
-                    st.markdown(result)
+                # 結果存在 session_state,只在按下分析按鈕的那次 rerun 呼叫 (付費) API
+                # 執行中的請求無法取消:若被其他元件操作中斷,之後的 rerun 不會自動重送
+                # 雙 AI 模式並行送出,各自完成即顯示,總等待時間 = 較慢的一方
+                requested = st.session_state.pop('ai_request', False)
+                providers = list(AI_PROVIDERS) if st.session_state.ai_provider == 'both' else [st.session_state.ai_provider]
+                ai_results = st.session_state.setdefault('ai_results', {})
+                prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+                st.markdown("#### 📊 AI 分析結果")
+                if ai_results and ai_results.get('prompt_hash') != prompt_hash:
+                    st.caption("ℹ️ 數據已更新,以下為先前數據的分析結果;再按一次分析按鈕即可更新")
+                placeholders = {}
+                for col, provider in zip(st.columns(len(providers)), providers):
+                    if len(providers) > 1: col.markdown(f"##### {AI_PROVIDERS[provider][0]}")
+                    placeholders[provider] = col.empty()
+                    if provider in ai_results: placeholders[provider].markdown(ai_results[provider])
+                    elif requested: placeholders[provider].info(f"🤖 {provider.upper()} 分析中...")
+                    else: placeholders[provider].warning(f"⚠️ {AI_PROVIDERS[provider][0]} 分析被中斷,請再按一次分析按鈕")
+                missing = [p for p in providers if p not in ai_results]
+                if missing and requested:
+                    ai_results['prompt_hash'] = prompt_hash
+                    for provider, result in ask_ai_concurrently(prompt, missing):
+                        ai_results[provider] = result
+                        placeholders[provider].markdown(result)
+        
+        # === 訊號回測 ===
+        with st.expander("🧪 訊號回測 (OI 大牆 / GEX / Max Pain / P/C 比 vs 實際結算價)"):
+            history_version = get_chain_history_version()
+            st.caption(f"已保存 {history_version[0]} 個交易日報表 (最新: {history_version[1] or 'N/A'}),結算價由結算日報表還原")
+            if st.button("▶️ 執行回測"):
+                st.session_state.run_backtest = True
+            if st.session_state.get('run_backtest'):
+                with st.spinner("🔄 平行回測中..."):
+                    bt = get_backtest_results(history_version)
+                if bt is None or bt.empty:
+                    st.info("歷史資料不足:需要同時保存交易日與其結算日的報表")
+                else:
+                    b1, b2, b3, b4 = st.columns(4)
+                    b1.metric("結算落在 OI 大牆區間", f"{bt['in_wall_range'].mean()*100:.0f}%")
+                    b2.metric("Max Pain 平均誤差", f"{bt['max_pain_err'].mean():.0f} 點")
+                    b3.metric("GEX 最大履約價平均誤差", f"{bt['gex_err'].mean():.0f} 點")
+                    b4.metric("P/C 比方向命中率", f"{bt['pc_hit'].dropna().astype(float).mean()*100:.0f}%" if bt['pc_hit'].notna().any() else "N/A")
+                    st.dataframe(bt, use_container_width=True, hide_index=True)
         
         # 廣告區
         st.markdown("---")
@@ -0,0 +1,87 @@
+"""訊號回測:重播保存的每日報表,比較 OI 大牆 / GEX / Max Pain / P/C 比與實際結算價
+獨立成模組,讓 process pool 子行程能以 backtest.backtest_one 匯入,不受 Streamlit rerun 影響"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analytics import get_settlement_date, calculate_dealer_gex, calculate_implied_forwards, calculate_max_pain
+
+def _put_call_pairs(df):
+    is_call = df['Type'].astype(str).str.contains('Call|買')
+    pairs = pd.merge(
+        df[is_call].groupby('Strike')['Price'].mean().rename('Call'),
+        df[~is_call].groupby('Strike')['Price'].mean().rename('Put'),
+        left_index=True, right_index=True
+    )
+    return pairs[(pairs['Call'] > 0) | (pairs['Put'] > 0)]
+
+def infer_settlement_price(df_expiry):
+    """結算日報表中到期序列的結算價即內含價值,以 K + C - P 的中位數還原最後結算價"""
+    pairs = _put_call_pairs(df_expiry)
+    if pairs.empty: return None
+    return float(np.median(pairs.index.to_numpy(dtype=float) + pairs['Call'] - pairs['Put']))
+
+def build_backtest_tasks(history):
+    """每個 (交易日, 合約) 一筆任務;結算價取自結算日當天保存的報表"""
+    by_date = {h['date']: h['df'] for h in history}
+    settle_prices = {}
+    tasks = []
+    for data_date, df in by_date.items():
+        for contract in df['Month'].dropna().unique():
+            settlement_date = get_settlement_date(contract)
+            if settlement_date <= data_date or settlement_date not in by_date: continue
+            if contract not in settle_prices:
+                df_expiry = by_date[settlement_date]
+                settle_prices[contract] = infer_settlement_price(df_expiry[df_expiry['Month'] == contract])
+            if settle_prices[contract] is None: continue
+            tasks.append({
+                'data_date': data_date, 'contract': contract, 'settlement_date': settlement_date,
+                'settle': settle_prices[contract], 'df': df[df['Month'] == contract]
+            })
+    return tasks
+
+def backtest_one(task):
+    """單一 (交易日, 合約) 的訊號與實際結算價比較 (在子行程中執行)"""
+    df, settle = task['df'], task['settle']
+    is_call = df['Type'].astype(str).str.contains('Call|買')
+    call_oi = df[is_call].groupby('Strike')['OI'].sum()
+    put_oi = df[~is_call].groupby('Strike')['OI'].sum()
+    forwards = calculate_implied_forwards(df, [{'code': task['contract'], 'date': task['settlement_date']}], as_of=task['data_date'])
+    ref_price = float(forwards['Forward'].iloc[0]) if forwards is not None and not forwards.empty else None
+    pricing_spot = float(forwards['Pricing_Spot'].iloc[0]) if ref_price else None
+    gex = calculate_dealer_gex(df, pricing_spot, task['settlement_date'], as_of=task['data_date']) if pricing_spot else None
+    call_amt, put_amt = df[is_call]['Amount'].sum(), df[~is_call]['Amount'].sum()
+    pc_ratio = put_amt / call_amt * 100 if call_amt > 0 else np.nan
+    call_wall = call_oi.idxmax() if not call_oi.empty else np.nan
+    put_wall = put_oi.idxmax() if not put_oi.empty else np.nan
+    gex_strike = gex.loc[gex['GEX'].abs().idxmax(), 'Strike'] if gex is not None else np.nan
+    max_pain = calculate_max_pain(df)
+    return {
+        'data_date': task['data_date'], 'contract': task['contract'], 'settlement_date': task['settlement_date'],
+        'settle': settle, 'ref_price': ref_price,
+        'call_wall': call_wall, 'put_wall': put_wall, 'in_wall_range': bool(put_wall <= settle <= call_wall),
+        'max_pain': max_pain, 'max_pain_err': abs(settle - max_pain) if max_pain is not None else np.nan,
+        'gex_strike': gex_strike, 'gex_err': abs(settle - gex_strike),
+        'pc_ratio': pc_ratio,
+        'pc_hit': bool((pc_ratio > 100) == (settle > ref_price)) if ref_price and not np.isnan(pc_ratio) else None,
+    }
+
+def run_backtest(tasks, max_workers=None):
+    """以 process pool (forkserver / spawn,不從多執行緒的 Streamlit 直接 fork) 平行回測各交易日
+    建立或執行 pool 失敗時改為循序執行"""
+    if not tasks: return None
+    results = None
+    if len(tasks) > 1:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+                results = list(pool.map(backtest_one, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+        except Exception:
+            results = None
+    if results is None:
+        results = [backtest_one(t) for t in tasks]
+    return pd.DataFrame(results).sort_values(['data_date', 'contract']).reset_index(drop=True)